@@ -1,23 +1,24 @@
+import itertools
 import os
 import random
 import subprocess
-import tempfile
 import urllib.parse
+from array import array
+from collections.abc import Callable, Iterator, Sequence
+from concurrent.futures import as_completed
+from concurrent.futures.thread import ThreadPoolExecutor
+from functools import cache, lru_cache, partial
 from pathlib import Path
 
 import attrs
 import httpx
-import orjson
 import rich
 import stamina
 import structlog
 import typer
-from atproto import Client
-from atproto_client.models.app.bsky.embed.defs import AspectRatio
-from mastodon import Mastodon, MastodonServiceUnavailableError
 
-from cfgbot import github
-from cfgbot.image import Image
+from cfgbot import disk_cache, github
+from cfgbot.image import IMAGE_FORMATS, Image, ImageFormat
 from cfgbot.index import Index, GithubIndex, GhidraIndex, GithubFunction, GhidraFunction
 from cfgbot.message import Link, Post, GhidraPost, GithubPost
 
@@ -37,28 +38,64 @@ MINIMAL_NODE_COUNT = 7
 
 COLOR_SCHEMES = ["dark", "light"]
 
+
+def _get_image_format() -> ImageFormat:
+    # Fail on a typo before anything is rendered
+    image_format = os.getenv("IMAGE_FORMAT", "png")
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(
+            f"IMAGE_FORMAT must be one of {IMAGE_FORMATS}, found {image_format!r}"
+        )
+    return image_format
+
+
+#: "png", or "webp" for smaller (lossy) uploads
+IMAGE_FORMAT = _get_image_format()
+
+#: Seconds to keep disk cache entries (rendered SVGs, filtered indices) around
+CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
 log = structlog.get_logger()
 
 app = typer.Typer()
 
 
-def choose_function_from(indices: list[Index]):
-    index = random.choices(indices)
-    match index.content:
-        case GithubIndex(functions=functions):
-            interesting_functions = [
-                function
-                for function in functions
-                if function.node_count >= MINIMAL_NODE_COUNT
-            ]
-            return index.content, random.choice(interesting_functions)
-        case GhidraIndex(functions=functions):
-            raise NotImplementedError()
+@cache
+def get_renderer_revision(script: str) -> str | None:
+    """Revision of the renderer checkout, or `None` if its SVGs can't be cached."""
+    # The script imports the rest of the renderer and its color schemes,
+    # so the whole checkout is versioned, not just the script.
+    checkout = str(Path(script).parent)
+    try:
+        revision = subprocess.check_output(
+            ["git", "-C", checkout, "rev-parse", "HEAD"],
+            text=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+        # Untracked files are left out, as they are mostly build output
+        changes = subprocess.check_output(
+            ["git", "-C", checkout, "status", "--porcelain", "--untracked-files=no"],
+            text=True,
+            stderr=subprocess.DEVNULL,
+        )
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        log.warning("Renderer revision unknown. Not caching SVGs.", script=script)
+        return None
+
+    if changes.strip():
+        log.warning(
+            "Renderer has uncommitted changes. Not caching SVGs.", script=script
+        )
+        return None
+    return revision
 
 
-def render_function_svg(
-    sourcefile: Path, colors: str, function: GithubFunction
-) -> bytes:
+@cache
+def get_bun_version() -> str:
+    return subprocess.check_output(["bun", "--version"], text=True).strip()
+
+
+def run_bun_script(script: str, colors: str, input_file: Path, *args: str) -> bytes:
     return subprocess.check_output(
         list(
             filter(
@@ -66,37 +103,69 @@ def render_function_svg(
                 [
                     "bun",
                     "run",
-                    FUNCTION_RENDER_SCRIPT,
+                    script,
                     "--dot",
-                    "graph.dot",
+                    f"graph-{colors}.dot",
                     "--colors" if colors else None,
                     colors if colors else None,
-                    str(sourcefile.absolute()),
-                    function.start_position.model_dump_json(),
+                    str(input_file.absolute()),
+                    *args,
                 ],
             )
         )
     )
 
 
+def run_render_script(script: str, colors: str, input_file: Path, *args: str) -> bytes:
+    revision = get_renderer_revision(script)
+    if revision is None:
+        return run_bun_script(script, colors, input_file, *args)
+
+    # Rendering is deterministic, so SVGs are cached by renderer version, options,
+    # and input content.
+    key = disk_cache.make_key(
+        script,
+        revision,
+        get_bun_version(),
+        colors,
+        disk_cache.digest_file(input_file),
+        *args,
+    )
+    svg = disk_cache.read("svgs", key)
+    if svg is None:
+        svg = run_bun_script(script, colors, input_file, *args)
+        try:
+            disk_cache.write("svgs", key, svg)
+        except OSError:
+            log.warning("Failed caching SVG", script=script, exc_info=True)
+    return svg
+
+
+def render_function_svg(sourcefile: Path, colors: str, start_position: str) -> bytes:
+    if FUNCTION_RENDER_SCRIPT is None:
+        raise RuntimeError("FUNCTION_RENDER_SCRIPT is not set")
+    return run_render_script(FUNCTION_RENDER_SCRIPT, colors, sourcefile, start_position)
+
+
 def render_graph_svg(graph_file: Path, colors: str) -> bytes:
-    return subprocess.check_output(
-        list(
-            filter(
-                None,
-                [
-                    "bun",
-                    "run",
-                    GRAPH_RENDER_SCRIPT,
-                    "--dot",
-                    "graph.dot",
-                    "--colors" if colors else None,
-                    colors if colors else None,
-                    str(graph_file.absolute()),
-                ],
-            )
+    if GRAPH_RENDER_SCRIPT is None:
+        raise RuntimeError("GRAPH_RENDER_SCRIPT is not set")
+    return run_render_script(GRAPH_RENDER_SCRIPT, colors, graph_file)
+
+
+def render_images(
+    render_svg: Callable[[str], bytes], colors_schemes: list[str]
+) -> list[Image]:
+    # Schemes are independent, and bun & cairo spend most of their time outside the GIL.
+    def render_image(colors: str) -> Image:
+        return Image.from_svg(
+            svg=render_svg(colors),
+            alt=f"A control-flow-graph of the function described in the post text using a {colors} color scheme.",
+            image_format=IMAGE_FORMAT,
         )
-    )
+
+    with ThreadPoolExecutor(max_workers=max(1, len(colors_schemes))) as executor:
+        return list(executor.map(render_image, colors_schemes))
 
 
 @attrs.frozen(kw_only=True)
@@ -106,45 +175,114 @@ class IndexLocator:
     raw_url_base: str
 
 
+@attrs.frozen(kw_only=True)
+class LoadedIndex:
+    #: Index content, holding only functions with at least MINIMAL_NODE_COUNT nodes
+    content: GithubIndex | GhidraIndex
+    #: Cumulative selection weights of the interesting functions
+    cum_weights: array[int] = attrs.field(init=False)
+
+    @cum_weights.default
+    def _cum_weights_default(self) -> array[int]:
+        return array(
+            "q",
+            itertools.accumulate(
+                function.node_count + WEIGHT_OFFSET
+                for function in self.interesting_functions
+            ),
+        )
+
+    @property
+    def interesting_functions(self) -> list[GithubFunction] | list[GhidraFunction]:
+        return self.content.functions
+
+    def choose_position(self) -> int:
+        """Choose a position in `interesting_functions`, weighted by node count."""
+        return random.choices(
+            range(len(self.interesting_functions)), cum_weights=self.cum_weights, k=1
+        )[0]
+
+    def choose_function(self) -> GithubFunction | GhidraFunction:
+        return self.interesting_functions[self.choose_position()]
+
+
+def _filter_index(index: Index) -> Index:
+    interesting_functions = [
+        function
+        for function in index.content.functions
+        if function.node_count >= MINIMAL_NODE_COUNT
+    ]
+    return index.model_copy(
+        update={
+            "content": index.content.model_copy(
+                update={"functions": interesting_functions}
+            )
+        }
+    )
+
+
+def _filtered_index_key(path: Path, mtime_ns: int) -> str:
+    return disk_cache.make_key(
+        str(path.resolve()), str(mtime_ns), str(MINIMAL_NODE_COUNT)
+    )
+
+
+@lru_cache(maxsize=16)
+def _load_index(path: Path, mtime_ns: int) -> LoadedIndex:
+    # The filtered index only holds the interesting functions,
+    # so it is far quicker to parse than the full one.
+    key = _filtered_index_key(path, mtime_ns)
+    if (filtered := disk_cache.read("indices", key)) is not None:
+        index = Index.model_validate_json(filtered)
+    else:
+        index = _filter_index(Index.model_validate_json(path.read_bytes()))
+        try:
+            disk_cache.write("indices", key, index.model_dump_json().encode())
+        except OSError:
+            log.warning("Failed caching filtered index", path=path, exc_info=True)
+    return LoadedIndex(content=index.content)
+
+
+def load_index(path: Path) -> LoadedIndex:
+    # The mtime is part of the cache key, so modified indices are reloaded.
+    return _load_index(path, path.stat().st_mtime_ns)
+
+
+def choose_function_from(indices: list[LoadedIndex]):
+    index = random.choice(indices)
+    return index.content, index.choose_function()
+
+
 def generate_post(
-    index_paths: list[Path | IndexLocator], colors_schemes: list[str]
+    index_paths: Sequence[Path | IndexLocator], colors_schemes: list[str]
 ) -> tuple[Post, list[Image]]:
     index_path: Path | IndexLocator = random.choice(index_paths)
     log.info("Index selected", index=index_path)
     match index_path:
         case Path():
-            index = Index(**orjson.loads(index_path.read_text())).content
+            loaded_index = load_index(index_path)
         case IndexLocator():
-            index = Index(**orjson.loads(index_path.path.read_text())).content
+            loaded_index = load_index(index_path.path)
         case _:
             raise TypeError(f"expected Path or IndexLocator, found {type(index_path)}")
 
-    if isinstance(index, GithubIndex):
-        return generate_github_post(index, colors_schemes)
+    if isinstance(loaded_index.content, GithubIndex):
+        return generate_github_post(loaded_index, colors_schemes)
     else:
-        return generate_ghidra_post(index_path, index, colors_schemes)
+        return generate_ghidra_post(index_path, loaded_index, colors_schemes)
 
 
 def generate_ghidra_post(
-    index_locator: IndexLocator, index: GhidraIndex, colors_schemes: list[str]
+    index_locator: IndexLocator, loaded_index: LoadedIndex, colors_schemes: list[str]
 ) -> tuple[GhidraPost, list[Image]]:
-    interesting_functions = [
-        function
-        for function in index.functions
-        if function.node_count >= MINIMAL_NODE_COUNT
-    ]
-    function: GhidraFunction = random.choice(interesting_functions)
+    index = loaded_index.content
+    if not isinstance(index, GhidraIndex):
+        raise TypeError(f"expected GhidraIndex, found {type(index)}")
+    function = index.functions[loaded_index.choose_position()]
     log.info("Function selected", function=function)
     index_dir = index_locator.path.parent
     graph_path = index_dir / f"{function.address}.json"
-    images = []
-    for colors in colors_schemes:
-        svg = render_graph_svg(graph_path, colors)
-        image = Image.from_svg(
-            svg=svg,
-            alt=f"A control-flow-graph of the function described in the post text using a {colors} color scheme.",
-        )
-        images.append(image)
+    images = render_images(partial(render_graph_svg, graph_path), colors_schemes)
 
     graph_url = f"{index_locator.raw_url_base}/{graph_path.relative_to(index_locator.repo_base)!s}".replace(
         "\\", "/"
@@ -162,38 +300,50 @@ def generate_ghidra_post(
     ), images
 
 
+@cache
+def get_http_client() -> httpx.Client:
+    return httpx.Client(
+        timeout=10.0,
+        follow_redirects=True,
+        limits=httpx.Limits(max_keepalive_connections=4),
+    )
+
+
 @stamina.retry(on=httpx.ReadTimeout)
-def fetch_github_function(function: GithubFunction, index: GithubIndex):
-    return httpx.get(
-        github.get_raw_url(
-            project=index.project, ref=index.ref, filename=function.filename
-        )
-    ).text
+def download_github_file(project: str, ref: str, filename: str, cache_key: str):
+    url = github.get_raw_url(project=project, ref=ref, filename=filename)
+    with get_http_client().stream("GET", url) as response:
+        response.raise_for_status()
+        with disk_cache.writer("sources", cache_key) as file:
+            for chunk in response.iter_bytes():
+                file.write(chunk)
+
+
+def fetch_github_function(function: GithubFunction, index: GithubIndex) -> Path:
+    # Files at a given ref never change, so they can be cached indefinitely.
+    # The original name is kept, as the renderer detects the language from it.
+    name = Path(function.filename).name
+    key = f"{disk_cache.make_key(index.project, index.ref, function.filename)}/{name}"
+    path = disk_cache.get_path("sources", key)
+    if not path.exists():
+        download_github_file(index.project, index.ref, function.filename, key)
+    return path
 
 
 def generate_github_post(
-    index: GithubIndex, colors_schemes: list[str]
+    loaded_index: LoadedIndex, colors_schemes: list[str]
 ) -> tuple[GithubPost, list[Image]]:
-    interesting_functions = [
-        function
-        for function in index.functions
-        if function.node_count >= MINIMAL_NODE_COUNT
-    ]
-    function: GithubFunction = random.choice(interesting_functions)
+    index = loaded_index.content
+    if not isinstance(index, GithubIndex):
+        raise TypeError(f"expected GithubIndex, found {type(index)}")
+    function = index.functions[loaded_index.choose_position()]
     log.info("Function selected", function=function)
-    code = fetch_github_function(function, index)
-    with tempfile.TemporaryDirectory() as tempdir:
-        codefile = Path(tempdir, Path(function.filename).name)
-        codefile.write_text(code)
-
-        images = []
-        for colors in colors_schemes:
-            svg = render_function_svg(codefile, colors, function)
-            image = Image.from_svg(
-                svg=svg,
-                alt=f"A control-flow-graph of the function described in the post text using a {colors} color scheme.",
-            )
-            images.append(image)
+    codefile = fetch_github_function(function, index)
+    start_position = function.start_position.model_dump_json()
+    images = render_images(
+        partial(render_function_svg, codefile, start_position=start_position),
+        colors_schemes,
+    )
     line = function.start_position.row + 1
     code_url = github.get_code_url(
         index.project, index.ref, filename=function.filename, line=line
@@ -213,30 +363,55 @@ def generate_github_post(
     return post, images
 
 
+@lru_cache(maxsize=1024)
 def render_github_url(github_link: str, colors: str) -> str:
     return f"https://tmr232.github.io/function-graph-overview/render/?github={urllib.parse.quote_plus(github_link)}&colors={colors}"
 
 
+@lru_cache(maxsize=1024)
 def render_graph_url(ghidra_link: str, colors: str) -> str:
     return f"https://tmr232.github.io/function-graph-overview/render/?graph={urllib.parse.quote_plus(ghidra_link)}&colors={colors}"
 
 
-def find_github_indices() -> list[Path | IndexLocator]:
+def iter_ghidra_index_paths(root: str) -> Iterator[Path]:
+    # An index sits next to the thousands of graph files it describes,
+    # so once we find one there's no need to look any deeper.
+    subdirs = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.name == "index.json" and entry.is_file():
+                yield Path(entry.path)
+                return
+            if not entry.name.startswith(".") and entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+
+    for subdir in subdirs:
+        yield from iter_ghidra_index_paths(subdir)
+
+
+@cache
+def find_github_indices() -> tuple[Path | IndexLocator, ...]:
     ghidra_index_locators = []
-    for index_path in Path(GHIDRA_EXPORT_ROOT).rglob("**/index.json"):
-        ghidra_index_locators.append(
-            IndexLocator(
-                path=index_path,
-                repo_base=Path(GHIDRA_EXPORT_ROOT),
-                raw_url_base=GHIDRA_RAW_URL_BASE,
+    if GHIDRA_EXPORT_ROOT is None:
+        log.warning("GHIDRA_EXPORT_ROOT is not set. Skipping Ghidra indices.")
+    else:
+        for index_path in iter_ghidra_index_paths(GHIDRA_EXPORT_ROOT):
+            ghidra_index_locators.append(
+                IndexLocator(
+                    path=index_path,
+                    repo_base=Path(GHIDRA_EXPORT_ROOT),
+                    raw_url_base=GHIDRA_RAW_URL_BASE,
+                )
             )
-        )
     github_code_indices = list((Path(__file__).parent / "indices").glob("*.json"))
-    return ghidra_index_locators + github_code_indices
+    return (*ghidra_index_locators, *github_code_indices)
 
 
 @app.command()
 def main():
+    # Renderer and index updates leave the old entries unused
+    disk_cache.prune("svgs", CACHE_MAX_AGE)
+    disk_cache.prune("indices", CACHE_MAX_AGE)
     log.info("Loading indices")
     index_paths = find_github_indices()
     log.info("Indices found", indices=index_paths)
@@ -244,19 +419,18 @@ def main():
     post, images = generate_post(index_paths, colors_schemes=COLOR_SCHEMES)
     rich.print(post)
     failed = False
-    try:
-        log.info("Posting to Bluesky")
-        post_to_bluesky(post, images)
-    except Exception:
-        failed = True
-        log.exception("Failed posting to bluesky", post=post)
-
-    try:
-        log.info("Posting to Mastodon")
-        post_to_mastodon(post, images)
-    except Exception:
-        failed = True
-        log.exception("Failed posting to Mastodon", post=post)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        log.info("Posting to Bluesky and Mastodon")
+        futures = {
+            executor.submit(post_to_bluesky, post, images): "Bluesky",
+            executor.submit(post_to_mastodon, post, images): "Mastodon",
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                failed = True
+                log.exception(f"Failed posting to {futures[future]}", post=post)
 
     if failed:
         raise RuntimeError("Failed posting to at least one platform")
@@ -264,38 +438,73 @@ def main():
     log.info("Posting successful")
 
 
-from atproto_client.request import Request
+# atproto and mastodon are slow to import, so they are only imported when posting.
 
 
-class MyRequest(Request):
-    def __init__(self):
-        super().__init__()
-        self._client = httpx.Client(timeout=10.0, follow_redirects=True)
+def make_bluesky_request():
+    from atproto_client.request import Request
 
+    request = Request()
+    request._client = get_http_client()
+    return request
 
-def post_to_bluesky(post: Post, images: list[Image]):
-    client = Client(request=MyRequest())
+
+@cache
+def get_bluesky_client():
+    # The client refreshes its session by itself once the access token expires.
+    from atproto import Client
+
+    client = Client(request=make_bluesky_request())
     client.login(BLUESKY_IDENTIFIER, BLUESKY_PASSWORD)
+    return client
+
+
+def post_to_bluesky(post: Post, images: list[Image]):
+    from atproto_client.models.app.bsky.embed.defs import AspectRatio
+
+    client = get_bluesky_client()
+
+    image_bytes, image_alts, image_aspect_ratios = [], [], []
+    for image in images:
+        image_bytes.append(image.image_bytes)
+        image_alts.append(image.alt)
+        # Our sizes are always valid, so skip pydantic validation.
+        image_aspect_ratios.append(
+            AspectRatio.model_construct(height=image.height, width=image.width)
+        )
 
     client.send_images(
         post.into_bsky(),
-        images=[image.image_bytes for image in images],
-        image_alts=[image.alt for image in images],
-        image_aspect_ratios=[
-            AspectRatio(height=image.height, width=image.width) for image in images
-        ],
+        images=image_bytes,
+        image_alts=image_alts,
+        image_aspect_ratios=image_aspect_ratios,
     )
 
 
-@stamina.retry(on=MastodonServiceUnavailableError, attempts=3, wait_initial=5.0)
-def post_to_mastodon(post: Post, images: list[Image]):
-    mastodon = Mastodon(
+def is_mastodon_unavailable(exception: Exception) -> bool:
+    from mastodon import MastodonServiceUnavailableError
+
+    return isinstance(exception, MastodonServiceUnavailableError)
+
+
+@cache
+def get_mastodon_client():
+    from mastodon import Mastodon
+
+    return Mastodon(
         access_token=MASTODON_ACCESS_TOKEN, api_base_url=MASTODON_API_BASE_URL
     )
-    media = [
-        mastodon.media_post(
-            image.image_bytes, mime_type="image/png", description=image.alt
+
+
+@stamina.retry(on=is_mastodon_unavailable, attempts=3, wait_initial=5.0)
+def post_to_mastodon(post: Post, images: list[Image]):
+    mastodon = get_mastodon_client()
+
+    def upload(image: Image):
+        return mastodon.media_post(
+            image.image_bytes, mime_type=image.mime_type, description=image.alt
         )
-        for image in images
-    ]
+
+    with ThreadPoolExecutor(max_workers=max(1, len(images))) as executor:
+        media = list(executor.map(upload, images))
     mastodon.status_post(post.into_mastodon(), media_ids=media)
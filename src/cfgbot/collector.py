@@ -3,22 +3,54 @@ from pathlib import Path
 from subprocess import CalledProcessError
 from typing import Iterable
 from functools import partial
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from concurrent.futures.thread import ThreadPoolExecutor
-import json
+import orjson
+import re
 import typer
 import tempfile
-from git import Repo
+from git import Git, Repo
 import os
-import glob
-from more_itertools import chunked
 import rich
 import structlog
 
+from cfgbot.index import Index
+
 log = structlog.get_logger()
 app = typer.Typer()
 
-FILES_PER_GROUP = 50
+FILES_PER_GROUP = int(os.getenv("CFGBOT_FILES_PER_GROUP", "1000"))
+# Larger files are generated or vendored code, and only bloat the index
+MAX_FILE_SIZE = 2 * 1024 * 1024
+# Leave room for the rest of the command line (and the environment, on POSIX)
+ARGV_BUDGET = 32767 - 4096 if os.name == "nt" else os.sysconf("SC_ARG_MAX") // 2
+# Number of bun processes to run at once, split between the projects being indexed
+SCAN_WORKERS = int(os.getenv("CFGBOT_SCAN_WORKERS") or os.cpu_count() or 2)
+FUNCTIONS_START_PATTERN = re.compile(rb'"functions"\s*:\s*\[')
+FUNCTIONS_END_PATTERN = re.compile(rb"\]\s*\}\s*\}\s*$")
+# The ref comes before the functions, so it is found in the first few KB
+INDEX_REF_PATTERN = re.compile(rb'"ref"\s*:\s*"([^"]+)"')
+INDEX_HEADER_LENGTH = 4096
 SCAN_CODEBASE_PATH = r"C:\Code\sandbox\function-graph-overview\scripts\scan-codebase.ts"
+SOURCE_PATTERNS = (
+    "*.c",
+    "*.h",
+    "*.cc",
+    "*.cpp",
+    "*.cxx",
+    "*.hh",
+    "*.hpp",
+    "*.go",
+    "*.py",
+    "*.js",
+    "*.jsx",
+    "*.ts",
+    "*.tsx",
+)
+SOURCE_EXTENSIONS = frozenset(pattern.removeprefix("*") for pattern in SOURCE_PATTERNS)
+# Vendored code. Names like `build` and `dist` also hold first-party code at times.
+EXCLUDED_DIRS = frozenset({"node_modules", "vendor", "third_party"})
 PROJECTS_TO_SCAN = (
     "kubernetes/kubernetes",
     "microsoft/typescript-go",
@@ -31,20 +63,54 @@ PROJECTS_TO_SCAN = (
 )
 
 
-def iter_file_groups(root, files_per_group):
-    yield from chunked(
-        filter(
-            lambda path: os.path.isfile(os.path.join(root, path)),
-            glob.iglob("**/*", root_dir=root, recursive=True),
-        ),
-        files_per_group,
-    )
+def iter_files(root: str, subdir: str = "") -> Iterable[str]:
+    # `DirEntry` reuses the file type reported by the directory listing,
+    # so only source files are stat'ed, to check their size.
+    subdirs = []
+    with os.scandir(os.path.join(root, subdir)) as entries:
+        # Sorted, so that indices list files in the same order on every run
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            # Like glob, skip hidden files and directories (including `.git`)
+            if entry.name.startswith("."):
+                continue
+            path = os.path.join(subdir, entry.name)
+            if entry.is_file(follow_symlinks=False):
+                if (
+                    os.path.splitext(entry.name)[1].lower() in SOURCE_EXTENSIONS
+                    and entry.stat(follow_symlinks=False).st_size <= MAX_FILE_SIZE
+                ):
+                    yield path
+            elif (
+                entry.is_dir(follow_symlinks=False) and entry.name not in EXCLUDED_DIRS
+            ):
+                subdirs.append(path)
+
+    for path in subdirs:
+        yield from iter_files(root, path)
+
+
+def iter_file_groups(root, files_per_group, argv_budget=ARGV_BUDGET):
+    group: list[str] = []
+    group_length = 0
+    for path in iter_files(root):
+        # Account for quoting and a separating space
+        length = len(os.fsencode(path)) + 3
+        if group and (
+            len(group) == files_per_group or group_length + length > argv_budget
+        ):
+            yield group
+            group, group_length = [], 0
+        group.append(path)
+        group_length += length
+
+    if group:
+        yield group
 
 
 def scan_files(
     root: str, gh_project: str, git_ref: str, files: list[str]
-) -> str | None:
-    with tempfile.NamedTemporaryFile("rt+") as outfile:
+) -> bytes | None:
+    with tempfile.NamedTemporaryFile() as outfile:
         try:
             subprocess.check_call(
                 [
@@ -68,28 +134,119 @@ def scan_files(
             return None
 
 
-def merge_indices(indices: Iterable[str]) -> str:
-    json_indices = map(json.loads, indices)
+def merge_parsed_indices(indices: Iterable[bytes]) -> bytes:
+    json_indices = map(orjson.loads, indices)
     merged_index = next(json_indices)
     for json_index in json_indices:
         merged_index["content"]["functions"].extend(json_index["content"]["functions"])
-    return json.dumps(merged_index)
+    return orjson.dumps(merged_index)
+
+
+def has_trailing_functions(index: bytes) -> bool:
+    """Check that `functions` is the last key of `content`,
+    which is itself the last key of the index.
+    """
+    json_index = orjson.loads(index)
+    content = json_index.get("content")
+    return (
+        list(json_index)[-1] == "content"
+        and isinstance(content, dict)
+        and list(content)[-1:] == ["functions"]
+    )
+
+
+def split_functions(index: bytes) -> tuple[bytes, bytes, bytes] | None:
+    """Split a serialized index around the body of its functions array.
+
+    Only the start of the array and the closing brackets are searched for,
+    so the index must have the layout checked by `has_trailing_functions`.
+    Returns `None` if either isn't found.
+    """
+    start = FUNCTIONS_START_PATTERN.search(index)
+    end = FUNCTIONS_END_PATTERN.search(index, max(0, len(index) - 64))
+    if start is None or end is None:
+        return None
+    return index[: start.end()], index[start.end() : end.start()], index[end.start() :]
+
+
+def get_functions_body(index: bytes) -> bytes:
+    if parts := split_functions(index):
+        return parts[1]
+    return orjson.dumps(orjson.loads(index)["content"]["functions"])[1:-1]
+
+
+def splice_indices(
+    first_parts: tuple[bytes, bytes, bytes], indices: Iterable[bytes]
+) -> bytes:
+    prefix, functions, suffix = first_parts
+    merged = [prefix]
+    for body in chain([functions], map(get_functions_body, indices)):
+        if not body.strip():
+            continue
+        if len(merged) > 1:
+            merged.append(b",")
+        merged.append(body)
+    merged.append(suffix)
+    return b"".join(merged)
+
+
+def merge_indices(indices: Iterable[bytes]) -> bytes:
+    # Splice the function arrays together as text,
+    # instead of parsing and re-serializing every function.
+    # All chunks come from the same scanner, so checking the layout of the first
+    # one is enough.
+    indices = iter(indices)
+    first = next(indices)
+    if has_trailing_functions(first) and (parts := split_functions(first)):
+        merged = splice_indices(parts, indices)
+    else:
+        merged = merge_parsed_indices(chain([first], indices))
+
+    # A single validation pass, instead of parsing every chunk
+    Index.model_validate_json(merged)
+    return merged
+
+
+def get_repo_url(gh_project: str) -> str:
+    return f"https://github.com/{gh_project}"
+
+
+def get_remote_head(repo_url: str) -> str:
+    # Prints "<sha>\tHEAD"
+    return str(Git().ls_remote(repo_url, "HEAD")).split()[0]
+
 
+def read_index_ref(path: Path) -> str | None:
+    with path.open("rb") as file:
+        header = file.read(INDEX_HEADER_LENGTH)
+    if match := INDEX_REF_PATTERN.search(header):
+        return match[1].decode()
 
-def scan_project(gh_project: str) -> str:
-    repo_url = f"https://github.com/{gh_project}"
+    try:
+        return orjson.loads(path.read_bytes())["content"]["ref"]
+    except (orjson.JSONDecodeError, KeyError):
+        return None
+
+
+def scan_project(gh_project: str, scan_workers: int = SCAN_WORKERS) -> bytes:
+    repo_url = get_repo_url(gh_project)
     with tempfile.TemporaryDirectory() as workdir:
         repo_dir = os.path.join(workdir, "repo")
         log.info("Cloning", repo_url=repo_url)
-        with Repo.clone_from(repo_url, repo_dir, depth=1) as repo:
+        # Only download the blobs of source files the scanner can read
+        with Repo.clone_from(
+            repo_url, repo_dir, depth=1, filter="blob:none", sparse=True
+        ) as repo:
+            repo.git.sparse_checkout("set", "--no-cone", *SOURCE_PATTERNS)
             log.info("Clone complete", repo_url=repo_url)
-            return scan_repo(gh_project, repo)
+            return scan_repo(gh_project, repo, scan_workers)
 
 
-def scan_repo(gh_project: str, repo: Repo) -> str:
+def scan_repo(gh_project: str, repo: Repo, scan_workers: int = SCAN_WORKERS) -> bytes:
     commit_hash = repo.head.commit.hexsha
-    repo_dir = repo.working_dir
-    with ThreadPoolExecutor(max_workers=2) as executor:
+    repo_dir = str(repo.working_dir)
+    with ThreadPoolExecutor(max_workers=scan_workers) as executor:
+        # Merged in file order, so regenerating an index doesn't reorder it
         return merge_indices(
             filter(
                 None,
@@ -101,15 +258,45 @@ def scan_repo(gh_project: str, repo: Repo) -> str:
         )
 
 
+def index_project(gh_project: str, out_path: Path, scan_workers: int):
+    if out_path.exists():
+        # Checking the remote HEAD is far cheaper than cloning and scanning again
+        head = get_remote_head(get_repo_url(gh_project))
+        if read_index_ref(out_path) == head:
+            log.info("Index is up to date. Moving to next project.", project=gh_project)
+            return
+        log.info("Index is outdated", project=gh_project, head=head)
+
+    log.info("Indexing", project=gh_project)
+    # Write atomically, so that a partial index is never mistaken for an up-to-date one
+    temp_path = out_path.with_suffix(".tmp")
+    temp_path.write_bytes(scan_project(gh_project, scan_workers))
+    os.replace(temp_path, out_path)
+    log.info("Indexing complete", project=gh_project)
+
+
 def index_projects(out_dir: Path):
     os.makedirs(out_dir, exist_ok=True)
-    for gh_project in PROJECTS_TO_SCAN:
-        log.info("Indexing", project=gh_project)
-        out_path = out_dir / f"{gh_project.replace("/","_")}.json"
-        if out_path.exists():
-            log.info("Index already exists. Moving to next project.")
-            continue
-        out_path.write_text(scan_project(gh_project))
+    failed = False
+    max_workers = max(1, min(len(PROJECTS_TO_SCAN), (os.cpu_count() or 2) // 2))
+    # Every project scans with its own share of the bun processes
+    scan_workers = max(1, SCAN_WORKERS // max_workers)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for gh_project in PROJECTS_TO_SCAN:
+            out_path = out_dir / f"{gh_project.replace("/","_")}.json"
+            future = executor.submit(index_project, gh_project, out_path, scan_workers)
+            futures[future] = gh_project
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                failed = True
+                log.exception("Failed indexing", project=futures[future])
+
+    if failed:
+        raise RuntimeError("Failed indexing at least one project")
 
 
 @app.command()
@@ -0,0 +1,64 @@
+import hashlib
+import os
+import tempfile
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO
+
+CACHE_DIR = Path(os.getenv("CFGBOT_CACHE_DIR") or Path.home() / ".cache" / "cfgbot")
+
+
+def make_key(*parts: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part.encode())
+        # Keeps ("ab", "c") and ("a", "bc") apart
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def digest_file(path: Path) -> str:
+    with path.open("rb") as file:
+        return hashlib.file_digest(file, "blake2b").hexdigest()
+
+
+def get_path(namespace: str, key: str) -> Path:
+    return CACHE_DIR / namespace / key
+
+
+def read(namespace: str, key: str) -> bytes | None:
+    try:
+        return get_path(namespace, key).read_bytes()
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def writer(namespace: str, key: str) -> Iterator[IO[bytes]]:
+    path = get_path(namespace, key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first, so that readers never see a partial entry.
+    # Once it is moved into place, there's nothing left for the cleanup to delete.
+    with tempfile.NamedTemporaryFile(dir=path.parent, delete_on_close=False) as temp:
+        yield temp
+        temp.close()
+        os.replace(temp.name, path)
+
+
+def write(namespace: str, key: str, data: bytes):
+    with writer(namespace, key) as file:
+        file.write(data)
+
+
+def prune(namespace: str, max_age: float):
+    """Remove entries written more than `max_age` seconds ago."""
+    cutoff = time.time() - max_age
+    for path in (CACHE_DIR / namespace).glob("**/*"):
+        try:
+            if path.is_file() and path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            # Pruned concurrently
+            pass
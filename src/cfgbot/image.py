@@ -1,12 +1,20 @@
-from typing import Self
+import io
+import re
+from typing import Literal, Self
 from xml.etree import ElementTree
 
 import attrs
-import cairosvg
 
 BSKY_MAX_HEIGHT = 2000
 BSKY_MAX_WIDTH = 2000
 
+# Graphviz puts width before height on the root element
+SVG_SIZE_PATTERN = re.compile(rb'<svg\b[^>]*?\swidth="(\d+)pt"[^>]*?\sheight="(\d+)pt"')
+SVG_HEADER_LENGTH = 4096
+
+WEBP_QUALITY = 90
+WEBP_METHOD = 4
+
 
 @attrs.frozen(kw_only=True)
 class Size:
@@ -19,30 +27,66 @@ def _parse_svg_length(value: str) -> int:
 
 
 def get_svg_size(svg: bytes):
-    root = ElementTree.XML(svg)
+    # Avoid parsing the entire document when we only need the root attributes.
+    if match := SVG_SIZE_PATTERN.search(svg, 0, SVG_HEADER_LENGTH):
+        return Size(width=int(match[1]), height=int(match[2]))
+
+    # Stop at the root element, instead of building the whole tree
+    events = ElementTree.iterparse(io.BytesIO(svg), events=("start",))
+    _, root = next(events)
+    events.close()
     return Size(
         height=_parse_svg_length(root.attrib["height"]),
         width=_parse_svg_length(root.attrib["width"]),
     )
 
 
+def png_to_webp(png: bytes) -> bytes:
+    import PIL.Image
+
+    webp = io.BytesIO()
+    PIL.Image.open(io.BytesIO(png)).save(
+        webp, "WEBP", quality=WEBP_QUALITY, method=WEBP_METHOD
+    )
+    return webp.getvalue()
+
+
+type ImageFormat = Literal["png", "webp"]
+IMAGE_FORMATS: tuple[ImageFormat, ...] = ("png", "webp")
+
+
 @attrs.frozen(kw_only=True)
 class Image:
     image_bytes: bytes
     width: int
     height: int
     alt: str
+    mime_type: str = "image/png"
 
     @classmethod
-    def from_svg(cls, *, svg: bytes, alt: str) -> Self:
+    def from_svg(
+        cls, *, svg: bytes, alt: str, image_format: ImageFormat = "png"
+    ) -> Self:
+        import cairosvg
+
         svg_size = get_svg_size(svg)
         if svg_size.height > svg_size.width:
             png = cairosvg.svg2png(svg, output_height=BSKY_MAX_HEIGHT)
         else:
             png = cairosvg.svg2png(svg, output_width=BSKY_MAX_WIDTH)
+
+        match image_format:
+            case "png":
+                image_bytes, mime_type = png, "image/png"
+            case "webp":
+                image_bytes, mime_type = png_to_webp(png), "image/webp"
+            case _:
+                raise ValueError(f"Unsupported image format {image_format!r}")
+
         return cls(
-            image_bytes=png,
+            image_bytes=image_bytes,
             height=svg_size.height,
             width=svg_size.width,
             alt=alt,
+            mime_type=mime_type,
         )
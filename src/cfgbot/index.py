@@ -1,11 +1,20 @@
 from typing import Literal, Union, Annotated
 
-from pydantic import BaseModel, PositiveInt, Field, StringConstraints
+from pydantic import BaseModel, ConfigDict, PositiveInt, Field, StringConstraints
 
 HexString = Annotated[str, StringConstraints(pattern=r"[0-9a-f]+")]
 
 
-class GhidraFunction(BaseModel):
+class FrozenModel(BaseModel):
+    """Base for index models.
+
+    Loaded indices are cached and shared, so they must not be modified.
+    """
+
+    model_config = ConfigDict(frozen=True)
+
+
+class GhidraFunction(FrozenModel):
     """Describes a single function from the binary.
 
     The JSON file containing the graph should match the `address` field.
@@ -19,7 +28,7 @@ class GhidraFunction(BaseModel):
     node_count: int
 
 
-class GhidraIndex(BaseModel):
+class GhidraIndex(FrozenModel):
     """Index of a Ghidra export
 
     Should sit in the same directory as the exported data.
@@ -42,12 +51,12 @@ class GhidraIndex(BaseModel):
     extra: dict[str, str] | None = None
 
 
-class Position(BaseModel):
+class Position(FrozenModel):
     row: int
     column: int
 
 
-class GithubFunction(BaseModel):
+class GithubFunction(FrozenModel):
     #: The function definition
     funcdef: str
     #: Number of nodes in the graph
@@ -58,7 +67,7 @@ class GithubFunction(BaseModel):
     start_position: Position
 
 
-class GithubIndex(BaseModel):
+class GithubIndex(FrozenModel):
     #: Used for discriminated union
     index_type: Literal["github"]
     #: user/project of the GitHub project
@@ -69,7 +78,7 @@ class GithubIndex(BaseModel):
     functions: list[GithubFunction]
 
 
-class Index(BaseModel):
+class Index(FrozenModel):
     #: Version of the model, to allow later modification
     version: Literal[1]
     #: The content of the index
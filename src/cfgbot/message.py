@@ -1,7 +1,12 @@
-from typing import Protocol, Self, Callable
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Protocol, Self, Callable
 
 import attrs
-from atproto import client_utils
+
+if TYPE_CHECKING:
+    # atproto is slow to import, so it is only imported when rendering for Bluesky
+    from atproto import client_utils
 
 BSKY_MAX_TEXT_LENGTH = 300
 MASTO_MAX_TEXT_LENGTH = 500
@@ -28,6 +33,9 @@ class GhidraPost:
     address: str
     funcdef: str | None
     svgs: list[Link]
+    _parts_cache: dict[MessageTemplate[Self], list[MessagePart]] = attrs.field(
+        factory=dict, init=False, eq=False, repr=False
+    )
 
     def abbreviated(self, excess_length: int) -> Self:
         if self.funcdef is None or excess_length > len(self.funcdef):
@@ -37,18 +45,18 @@ class GhidraPost:
         return attrs.evolve(self, funcdef=funcdef)
 
     def into_bsky(self) -> client_utils.TextBuilder:
-        length = masto_get_message_length(ghidra_message_template, self)
+        builder, length = bsky_render_and_measure(ghidra_message_template, self)
         excess_length = length - BSKY_MAX_TEXT_LENGTH
         if excess_length <= 0:
-            return bsky_render(ghidra_message_template, self)
+            return builder
 
         return bsky_render(ghidra_message_template, self.abbreviated(excess_length))
 
     def into_mastodon(self) -> str:
-        length = masto_get_message_length(ghidra_message_template, self)
+        text, length = masto_render_and_measure(ghidra_message_template, self)
         excess_length = length - MASTO_MAX_TEXT_LENGTH
         if excess_length <= 0:
-            return masto_render(ghidra_message_template, self)
+            return text
 
         return masto_render(ghidra_message_template, self.abbreviated(excess_length))
 
@@ -59,6 +67,9 @@ class GithubPost:
     code: Link
     funcdef: str
     svgs: list[Link]
+    _parts_cache: dict[MessageTemplate[Self], list[MessagePart]] = attrs.field(
+        factory=dict, init=False, eq=False, repr=False
+    )
 
     def abbreviated(self, excess_length: int) -> Self:
         if self.funcdef is None or excess_length > len(self.funcdef):
@@ -68,18 +79,18 @@ class GithubPost:
         return attrs.evolve(self, funcdef=funcdef)
 
     def into_bsky(self) -> client_utils.TextBuilder:
-        length = masto_get_message_length(github_message_template, self)
+        builder, length = bsky_render_and_measure(github_message_template, self)
         excess_length = length - BSKY_MAX_TEXT_LENGTH
         if excess_length <= 0:
-            return bsky_render(github_message_template, self)
+            return builder
 
         return bsky_render(github_message_template, self.abbreviated(excess_length))
 
     def into_mastodon(self) -> str:
-        length = masto_get_message_length(github_message_template, self)
+        text, length = masto_render_and_measure(github_message_template, self)
         excess_length = length - MASTO_MAX_TEXT_LENGTH
         if excess_length <= 0:
-            return masto_render(github_message_template, self)
+            return text
 
         return masto_render(github_message_template, self.abbreviated(excess_length))
 
@@ -127,16 +138,26 @@ def github_message_template(post: GithubPost) -> list[MessagePart]:
     return parts
 
 
+def get_message_parts[P](template: MessageTemplate[P], post: P) -> list[MessagePart]:
+    # Posts are frozen, so every render of a post can share the same parts
+    cache = getattr(post, "_parts_cache", None)
+    if cache is None:
+        return template(post)
+    if (parts := cache.get(template)) is None:
+        parts = cache[template] = template(post)
+    return parts
+
+
 def masto_render_list(links: list[Link]) -> str:
     return "\n" + "\n".join(f"  {link.text} {link.url}" for link in links)
 
 
 def masto_link_list_length(links: list[Link]) -> int:
-    return len(
-        masto_render_list(
-            [Link(text=link.text, url="x" * MASTODON_URL_LENGTH) for link in links]
-        )
+    # Matches `masto_render_list`, with every URL counted as MASTODON_URL_LENGTH
+    line_lengths = (
+        len("  ") + len(link.text) + 1 + MASTODON_URL_LENGTH for link in links
     )
+    return len("\n") + sum(line_lengths) + max(0, len(links) - 1)
 
 
 def bsky_render_list(
@@ -149,8 +170,13 @@ def bsky_render_list(
     return builder
 
 
+def bsky_link_list_length(links: list[Link]) -> int:
+    # Matches `bsky_render_list`, where only the link text is part of the text
+    return sum(len(link.text) for link in links) + len(", ") * max(0, len(links) - 1)
+
+
 def masto_get_message_length[P](template: MessageTemplate[P], post: P) -> int:
-    message_parts = template(post)
+    message_parts = get_message_parts(template, post)
     total_length = 0
     for part in message_parts:
         match part:
@@ -166,7 +192,7 @@ def masto_get_message_length[P](template: MessageTemplate[P], post: P) -> int:
 
 
 def bsky_get_message_length[P](template: MessageTemplate[P], post: P) -> int:
-    message_parts = template(post)
+    message_parts = get_message_parts(template, post)
     total_length = 0
     for part in message_parts:
         match part:
@@ -175,40 +201,63 @@ def bsky_get_message_length[P](template: MessageTemplate[P], post: P) -> int:
             case Link(text=text):
                 total_length += len(text)
             case list(links):
-                builder = bsky_render_list(client_utils.TextBuilder(), links)
-                total_length += len(builder.build_text())
+                total_length += bsky_link_list_length(links)
             case _:
                 raise TypeError(f"Unsupported part type {type(part)}")
     return total_length
 
 
-def masto_render[P](template: MessageTemplate[P], post: P) -> str:
-    message_parts = template(post)
+def masto_render_and_measure[P](
+    template: MessageTemplate[P], post: P
+) -> tuple[str, int]:
+    """Render the post, and measure it the way Mastodon does."""
+    message_parts = get_message_parts(template, post)
     text_parts = []
+    total_length = 0
     for part in message_parts:
         match part:
             case str(text):
                 text_parts.append(text)
+                total_length += len(text)
             case Link(text=text, url=url):
                 text_parts.append(f"{text} {url}")
+                total_length += len(text) + MASTODON_URL_LENGTH + 1
             case list(links):
                 text_parts.append(masto_render_list(links))
+                total_length += masto_link_list_length(links)
             case _:
                 raise TypeError(f"Unsupported part type {type(part)}")
-    return "".join(text_parts)
+    return "".join(text_parts), total_length
 
 
-def bsky_render[P](template: MessageTemplate[P], post: P) -> client_utils.TextBuilder:
-    message_parts = template(post)
+def masto_render[P](template: MessageTemplate[P], post: P) -> str:
+    return masto_render_and_measure(template, post)[0]
+
+
+def bsky_render_and_measure[P](
+    template: MessageTemplate[P], post: P
+) -> tuple[client_utils.TextBuilder, int]:
+    """Render the post, and measure it the way Bluesky does."""
+    from atproto import client_utils
+
+    message_parts = get_message_parts(template, post)
     builder = client_utils.TextBuilder()
+    total_length = 0
     for part in message_parts:
         match part:
             case str(text):
                 builder.text(text)
+                total_length += len(text)
             case Link(text=text, url=url):
                 builder.link(text, url)
+                total_length += len(text)
             case list(links):
                 bsky_render_list(builder, links)
+                total_length += bsky_link_list_length(links)
             case _:
                 raise TypeError(f"Unsupported part type {type(part)}")
-    return builder
+    return builder, total_length
+
+
+def bsky_render[P](template: MessageTemplate[P], post: P) -> client_utils.TextBuilder:
+    return bsky_render_and_measure(template, post)[0]
@@ -0,0 +1,189 @@
+import os
+import random
+import subprocess
+
+import orjson
+import pytest
+
+from cfgbot import cfgbot, disk_cache
+from cfgbot.index import GithubIndex
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk_cache, "CACHE_DIR", tmp_path / "cache")
+    return tmp_path / "cache"
+
+
+def make_github_index(node_counts) -> dict:
+    return {
+        "index_type": "github",
+        "project": "python/cpython",
+        "ref": "2bd5a7ab0f4a1f65ab8043001bd6e8416c5079bd",
+        "functions": [
+            {
+                "funcdef": f"def f{i}():",
+                "node_count": node_count,
+                "filename": "Lib/idlelib/search.py",
+                "start_position": {"row": i, "column": 0},
+            }
+            for i, node_count in enumerate(node_counts)
+        ],
+    }
+
+
+def write_index(path, node_counts):
+    path.write_bytes(
+        orjson.dumps({"version": 1, "content": make_github_index(node_counts)})
+    )
+
+
+@pytest.fixture
+def bun(monkeypatch):
+    calls = []
+
+    def run_bun_script(script, colors, input_file, *args):
+        calls.append(colors)
+        return b"<svg/>"
+
+    monkeypatch.setattr(cfgbot, "run_bun_script", run_bun_script)
+    monkeypatch.setattr(cfgbot, "get_bun_version", lambda: "1.1.44")
+    cfgbot.get_renderer_revision.cache_clear()
+    yield calls
+    cfgbot.get_renderer_revision.cache_clear()
+
+
+def make_renderer(root, *, commit: bool):
+    root.mkdir()
+    script = root / "render-function.ts"
+    script.write_text("render()")
+    if commit:
+        git = ["git", "-C", str(root), "-c", "user.name=x", "-c", "user.email=x@x"]
+        subprocess.run([*git, "init", "-q"], check=True)
+        subprocess.run([*git, "add", "."], check=True)
+        subprocess.run([*git, "commit", "-q", "-m", "init"], check=True)
+    return str(script)
+
+
+def render_twice(script, source):
+    for _ in range(2):
+        assert cfgbot.run_render_script(script, "dark", source) == b"<svg/>"
+
+
+def test_render_cache(tmp_path, cache_dir, bun):
+    script = make_renderer(tmp_path / "renderer", commit=True)
+    source = tmp_path / "main.py"
+    source.write_text("pass")
+
+    render_twice(script, source)
+    assert bun == ["dark"]
+
+
+def test_render_without_checkout(tmp_path, cache_dir, bun):
+    script = make_renderer(tmp_path / "renderer", commit=False)
+    source = tmp_path / "main.py"
+    source.write_text("pass")
+
+    render_twice(script, source)
+    assert bun == ["dark", "dark"]
+    assert not cache_dir.exists()
+
+
+def test_render_uncommitted_changes(tmp_path, cache_dir, bun):
+    script = make_renderer(tmp_path / "renderer", commit=True)
+    (tmp_path / "renderer" / "render-function.ts").write_text("render(changed)")
+    source = tmp_path / "main.py"
+    source.write_text("pass")
+
+    render_twice(script, source)
+    assert bun == ["dark", "dark"]
+
+
+def test_render_unwritable_cache(tmp_path, cache_dir, bun, monkeypatch):
+    def write(namespace, key, data):
+        raise PermissionError()
+
+    monkeypatch.setattr(disk_cache, "write", write)
+    script = make_renderer(tmp_path / "renderer", commit=True)
+    source = tmp_path / "main.py"
+    source.write_text("pass")
+
+    render_twice(script, source)
+    assert bun == ["dark", "dark"]
+
+
+def test_iter_ghidra_index_paths(tmp_path):
+    program = tmp_path / "program"
+    (program / "functions").mkdir(parents=True)
+    (program / "index.json").write_text("{}")
+    (program / "functions" / "index.json").write_text("{}")
+    sibling = tmp_path / "other" / "program"
+    sibling.mkdir(parents=True)
+    (sibling / "index.json").write_text("{}")
+    hidden = tmp_path / ".git"
+    hidden.mkdir()
+    (hidden / "index.json").write_text("{}")
+    (tmp_path / "loop").symlink_to(tmp_path)
+
+    assert sorted(cfgbot.iter_ghidra_index_paths(str(tmp_path))) == [
+        sibling / "index.json",
+        program / "index.json",
+    ]
+
+
+def test_cum_weights():
+    index = GithubIndex.model_validate(make_github_index([1, 2, 3]))
+    loaded = cfgbot.LoadedIndex(content=index)
+    offset = cfgbot.WEIGHT_OFFSET
+    assert list(loaded.cum_weights) == [
+        1 + offset,
+        1 + 2 + 2 * offset,
+        1 + 2 + 3 + 3 * offset,
+    ]
+
+
+def test_choose_position(tmp_path, cache_dir):
+    path = tmp_path / "index.json"
+    write_index(path, range(1, 11))
+    loaded = cfgbot.load_index(path)
+
+    random.seed(0)
+    chosen = {
+        loaded.interesting_functions[loaded.choose_position()].node_count
+        for _ in range(1000)
+    }
+    assert chosen == set(range(cfgbot.MINIMAL_NODE_COUNT, 11))
+
+
+def test_load_index(tmp_path, cache_dir):
+    path = tmp_path / "index.json"
+    write_index(path, [1, 7, 8])
+    first = cfgbot.load_index(path)
+    assert [f.node_count for f in first.interesting_functions] == [7, 8]
+    assert cfgbot.load_index(path) is first
+
+    write_index(path, [9])
+    os.utime(path, ns=(0, path.stat().st_mtime_ns + 1))
+    mtime_ns = path.stat().st_mtime_ns
+    assert [f.node_count for f in cfgbot.load_index(path).interesting_functions] == [9]
+
+    # With the in-memory cache gone, the filtered copy is read from disk
+    cfgbot._load_index.cache_clear()
+    path.write_bytes(b"not an index")
+    os.utime(path, ns=(0, mtime_ns))
+    assert [f.node_count for f in cfgbot.load_index(path).interesting_functions] == [9]
+
+
+def test_choose_function_from():
+    indices = [
+        cfgbot.LoadedIndex(
+            content=GithubIndex.model_validate(make_github_index(node_counts))
+        )
+        for node_counts in ([7, 8], [9])
+    ]
+
+    random.seed(0)
+    for _ in range(100):
+        content, function = cfgbot.choose_function_from(indices)
+        index = next(index for index in indices if index.content is content)
+        assert function in index.interesting_functions
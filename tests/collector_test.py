@@ -0,0 +1,109 @@
+from itertools import chain
+
+import orjson
+import pytest
+from pydantic import ValidationError
+
+from cfgbot.collector import iter_file_groups, merge_indices, read_index_ref
+
+
+def make_index(functions, **kwargs) -> bytes:
+    return orjson.dumps(
+        {
+            "version": 1,
+            "content": {
+                "index_type": "github",
+                "project": "python/cpython",
+                "ref": "2bd5a7ab0f4a1f65ab8043001bd6e8416c5079bd",
+                "functions": functions,
+            },
+        },
+        **kwargs,
+    )
+
+
+def make_function(i: int) -> dict:
+    return {
+        "funcdef": f'def "functions": [{i}]',
+        "node_count": i + 1,
+        "filename": "Lib/idlelib/search.py",
+        "start_position": {"row": i, "column": 0},
+    }
+
+
+def test_merge_indices():
+    functions = [make_function(i) for i in range(4)]
+    merged = merge_indices(
+        [
+            make_index(functions[:1]),
+            make_index([]),
+            make_index(functions[1:3], option=orjson.OPT_INDENT_2),
+            make_index(functions[3:]),
+        ]
+    )
+    assert orjson.loads(merged) == orjson.loads(make_index(functions))
+
+
+def test_merge_indices_unexpected_layout():
+    functions = [make_function(i) for i in range(2)]
+    reordered = orjson.dumps(
+        {
+            "content": {"functions": functions[1:], "project": "python/cpython"},
+            "version": 1,
+        }
+    )
+    merged = merge_indices([make_index(functions[:1]), reordered])
+    assert orjson.loads(merged) == orjson.loads(make_index(functions))
+
+
+def test_merge_indices_trailing_key():
+    # Ends in `]}}` like a regular index, but the array is not the functions
+    def make_tagged_index(functions) -> bytes:
+        index = orjson.loads(make_index(functions))
+        index["content"]["tags"] = ["x"]
+        return orjson.dumps(index)
+
+    functions = [make_function(i) for i in range(2)]
+    merged = merge_indices(
+        [make_tagged_index(functions[:1]), make_index(functions[1:])]
+    )
+    assert orjson.loads(merged)["content"]["functions"] == functions
+
+
+def test_merge_indices_invalid():
+    with pytest.raises(ValidationError):
+        merge_indices([make_index([{"node_count": 1}])])
+
+
+def test_iter_file_groups(tmp_path):
+    for name in ["a.py", "b.py", "c.py", ".hidden.py"]:
+        (tmp_path / name).write_text("pass")
+    (tmp_path / "README.md").write_text("# Readme")
+    for excluded in [".git", "node_modules"]:
+        (tmp_path / excluded).mkdir()
+        (tmp_path / excluded / "d.py").write_text("pass")
+
+    groups = list(iter_file_groups(tmp_path, files_per_group=2))
+    assert sorted(len(group) for group in groups) == [1, 2]
+    assert sorted(chain.from_iterable(groups)) == ["a.py", "b.py", "c.py"]
+
+    # Each path takes up its length, plus quotes and a space
+    groups = list(iter_file_groups(tmp_path, files_per_group=10, argv_budget=14))
+    assert [len(group) for group in groups] == [2, 1]
+
+
+def test_read_index_ref(tmp_path):
+    index_path = tmp_path / "index.json"
+    index_path.write_bytes(make_index([]))
+    assert read_index_ref(index_path) == "2bd5a7ab0f4a1f65ab8043001bd6e8416c5079bd"
+
+    # The ref isn't in the header, so the whole index is parsed
+    index_path.write_bytes(
+        orjson.dumps(
+            {"content": {"functions": [{"funcdef": "x" * 8192}], "ref": "abc"}}
+        )
+    )
+    assert read_index_ref(index_path) == "abc"
+
+    index_path.write_bytes(make_index([])[:20])
+    assert read_index_ref(index_path) is None
@@ -0,0 +1,31 @@
+import os
+import time
+
+import pytest
+
+from cfgbot import disk_cache
+
+
+def test_prune(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk_cache, "CACHE_DIR", tmp_path)
+    disk_cache.write("svgs", "old", b"old")
+    disk_cache.write("svgs", "new", b"new")
+    day_ago = time.time() - 24 * 60 * 60
+    os.utime(disk_cache.get_path("svgs", "old"), (day_ago, day_ago))
+
+    disk_cache.prune("svgs", max_age=60 * 60)
+    assert disk_cache.read("svgs", "old") is None
+    assert disk_cache.read("svgs", "new") == b"new"
+
+    # Missing namespaces are fine
+    disk_cache.prune("sources", max_age=0)
+
+
+def test_writer_failure(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk_cache, "CACHE_DIR", tmp_path)
+    with pytest.raises(RuntimeError), disk_cache.writer("sources", "key") as file:
+        file.write(b"partial")
+        raise RuntimeError()
+
+    assert disk_cache.read("sources", "key") is None
+    assert list((tmp_path / "sources").iterdir()) == []
@@ -0,0 +1,34 @@
+import io
+
+import PIL.Image
+
+from cfgbot.image import Size, get_svg_size, png_to_webp
+
+GRAPHVIZ_SVG = b"""<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN"
+ "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">
+<!-- Generated by graphviz -->
+<svg width="284pt" height="479pt"
+ viewBox="0.00 0.00 284.00 479.00" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">
+<g id="graph0" class="graph" stroke-width="2"></g>
+</svg>
+"""
+
+
+def test_svg_size_graphviz():
+    assert get_svg_size(GRAPHVIZ_SVG) == Size(width=284, height=479)
+
+
+def test_svg_size_fallback():
+    # Height before width isn't matched by the fast path
+    svg = b'<svg xmlns="http://www.w3.org/2000/svg" height="10pt" width="20pt"></svg>'
+    assert get_svg_size(svg) == Size(width=20, height=10)
+
+
+def test_png_to_webp():
+    png = io.BytesIO()
+    PIL.Image.new("RGB", (20, 10), "white").save(png, "PNG")
+
+    webp = PIL.Image.open(io.BytesIO(png_to_webp(png.getvalue())))
+    assert webp.format == "WEBP"
+    assert webp.size == (20, 10)
@@ -1,4 +1,12 @@
+import pytest
+from atproto import client_utils
+
 from cfgbot.message import (
+    MASTODON_URL_LENGTH,
+    bsky_link_list_length,
+    bsky_render_list,
+    masto_link_list_length,
+    masto_render_list,
     GhidraPost,
     Link,
     masto_render,
@@ -8,6 +16,8 @@ from cfgbot.message import (
     github_message_template,
     bsky_get_message_length,
     masto_get_message_length,
+    masto_render_and_measure,
+    bsky_render_and_measure,
 )
 
 
@@ -106,3 +116,35 @@ def test_failed_post():
     print(masto_get_message_length(github_message_template, post))
     print(post.into_mastodon())
     print(post.into_bsky().build_text())
+
+
+def test_render_and_measure():
+    post = GithubPost(
+        project=Link(text="project", url="https://example.com"),
+        code=Link(text="code", url="https://example.com"),
+        funcdef="funcdef",
+        svgs=[Link(text="dark", url="url"), Link(text="light", url="url")],
+    )
+
+    text, length = masto_render_and_measure(github_message_template, post)
+    assert text == masto_render(github_message_template, post)
+    assert length == masto_get_message_length(github_message_template, post)
+
+    builder, length = bsky_render_and_measure(github_message_template, post)
+    assert (
+        builder.build_text() == bsky_render(github_message_template, post).build_text()
+    )
+    assert length == len(builder.build_text())
+
+
+@pytest.mark.parametrize("count", [0, 1, 2, 3])
+def test_link_list_length(count: int):
+    links = [Link(text=f"link{i}", url="https://example.com") for i in range(count)]
+
+    masto_links = [
+        Link(text=link.text, url="x" * MASTODON_URL_LENGTH) for link in links
+    ]
+    assert masto_link_list_length(links) == len(masto_render_list(masto_links))
+
+    builder = bsky_render_list(client_utils.TextBuilder(), links)
+    assert bsky_link_list_length(links) == len(builder.build_text())